@@ -1,3 +1,4 @@
+from typing import List, Union
 from langgraph.graph import StateGraph, END
 from .state import GraphState
 from .nodes import (
@@ -5,6 +6,8 @@ from .nodes import (
     web_search_node,
     reflect_node,
     synthesize_node,
+    synthesize_speculative_node,
+    merge_speculative_node,
 )
 from .logger import get_logger
 
@@ -21,11 +24,12 @@ def should_continue_after_generate(state: GraphState) -> str:
         return "end_step"
     return "next_step"
 
-def should_continue_after_search(state: GraphState) -> str:
+def should_continue_after_search(state: GraphState) -> Union[str, List[str]]:
     if state_has_error(state) or not state.get("documents"):
         logger.info("--- [search] Error or empty documents ---")
         return "end_step"
-    return "next_step"
+    # Fan out: reflect and speculatively synthesize in parallel
+    return ["reflect_step", "speculate_step"]
 
 def should_continue_after_reflect(state: GraphState) -> str:
     if state_has_error(state):
@@ -45,6 +49,8 @@ workflow.add_node("generate_queries", generate_queries_node)
 workflow.add_node("web_search", web_search_node)
 workflow.add_node("reflect", reflect_node)
 workflow.add_node("synthesize", synthesize_node)
+workflow.add_node("synthesize_speculative", synthesize_speculative_node)
+workflow.add_node("merge_speculative", merge_speculative_node)
 
 # Set the entry point of the graph
 workflow.set_entry_point("generate_queries")
@@ -58,28 +64,42 @@ workflow.add_conditional_edges(
         "end_step": "synthesize",
     },
 )
-# Add conditional edge from web_search to either reflect or synthesize based on error detection
+# Fan out from web_search: reflect and a speculative synthesis run in parallel,
+# or fall back to synthesize directly on error / empty documents
 workflow.add_conditional_edges(
     "web_search",
     should_continue_after_search,
     {
-        "next_step": "reflect",
+        "reflect_step": "reflect",
+        "speculate_step": "synthesize_speculative",
         "end_step": "synthesize",
     },
 )
 
-# Add the conditional edge from the reflect node
+# Join both branches before deciding whether to loop
+workflow.add_edge(["reflect", "synthesize_speculative"], "merge_speculative")
+
+# Loop back to web_search, or finish with the speculative answer
 workflow.add_conditional_edges(
-    "reflect",
+    "merge_speculative",
     should_continue_after_reflect,
     {
         "next_step": "web_search",
-        "end_step": "synthesize",
+        "end_step": END,
     },
 )
 
 # The synthesize node is the final step
 workflow.add_edge("synthesize", END)
 
-# Compile the graph into a runnable application
-app = workflow.compile()
+def build_app(checkpointer=None):
+    """Compiles the graph into a runnable application.
+
+    Pass a checkpointer (e.g. langgraph's MemorySaver) to make runs resumable; every
+    invocation must then set a unique ``configurable.thread_id``, and the checkpointer
+    retains each step's state until it is discarded.
+    """
+    return workflow.compile(checkpointer=checkpointer)
+
+# The default app keeps no checkpoints, so runs need no thread_id and retain no state
+app = build_app()
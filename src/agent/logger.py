@@ -1,5 +1,8 @@
+import atexit
 import logging
+import logging.handlers
 import os
+import queue
 from pathlib import Path
 
 # Create logs directory if it doesn't exist
@@ -23,9 +26,17 @@ formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(messag
 file_handler.setFormatter(formatter)
 console_handler.setFormatter(formatter)
 
-# Add the handlers to the logger
-logger.addHandler(file_handler)
-logger.addHandler(console_handler)
+# Hand records to a background listener so logging calls never block on disk I/O.
+# respect_handler_level keeps the console limited to errors.
+log_queue = queue.Queue(-1)
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+listener = logging.handlers.QueueListener(
+    log_queue, file_handler, console_handler, respect_handler_level=True
+)
+listener.start()
+
+# Flush pending records on exit
+atexit.register(listener.stop)
 
 def get_logger():
     """Returns the configured logger instance."""
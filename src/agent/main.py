@@ -1,7 +1,31 @@
 import sys
-import json
+import asyncio
+import orjson
 from .graph import app
 from .state import GraphState
+from .tools import WebSearchTool
+
+async def stream_agent(initial_state: GraphState, config: dict) -> dict:
+    """Runs the graph, echoing partial answers to stderr, and returns the final state."""
+    final_state = {}
+    streamed = ""
+    async for mode, chunk in app.astream(initial_state, config=config, stream_mode=["custom", "values"]):
+        if mode == "values":
+            final_state = chunk
+            continue
+
+        partial = chunk.get("answer") or ""
+        if not partial.startswith(streamed):
+            # A new synthesis started (e.g. a speculative draft was discarded), start a fresh line
+            sys.stderr.write("\n")
+            streamed = ""
+        sys.stderr.write(partial[len(streamed):])
+        sys.stderr.flush()
+        streamed = partial
+
+    if streamed:
+        sys.stderr.write("\n")
+    return final_state
 
 def run_agent():
     """The main entry point for the research agent CLI."""
@@ -16,29 +40,34 @@ def run_agent():
     initial_state = GraphState(
         question=question,
         queries=[],
-        documents=[],
+        documents={},
         need_more=False,
         final_answer="",
         citations=[],
+        speculative_answer="",
+        speculative_citations=[],
         loop_count=0,
         max_iter=MAX_ITER,
         errors=[]
     )
 
-    config = {}
+    # One search tool per run, so repeated queries across search rounds hit its cache
+    config = {"configurable": {"search_tool": WebSearchTool()}}
 
     try:
-        # Invoke the LangGraph app
-        final_state = app.invoke(initial_state, config=config)
+        # Run the LangGraph app, streaming the answer as it is generated
+        final_state = asyncio.run(stream_agent(initial_state, config))
 
         # Print the final JSON output
         output = {
             "answer": final_state.get("final_answer"),
             "citations": final_state.get("citations", [])
         }
-        print(json.dumps(output, indent=2))
+        sys.stdout.buffer.write(orjson.dumps(output, option=orjson.OPT_INDENT_2 | orjson.OPT_APPEND_NEWLINE))
+        sys.stdout.flush()
 
     except Exception as e:
+        print(f"Error: {e}", file=sys.stderr)
         sys.exit(1)
 
 if __name__ == "__main__":
@@ -1,24 +1,43 @@
 import os
-import json
 import asyncio
-from typing import List, Optional
+import functools
+import json
+from itertools import zip_longest
+from typing import Any, Callable, List, Optional
 from dotenv import load_dotenv, find_dotenv
 from pathlib import Path
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
 
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.output_parsers.openai_tools import JsonOutputKeyToolsParser
 from pydantic import BaseModel, Field
-from openai import RateLimitError
 from langchain_core.runnables.base import Runnable
+from langchain_core.runnables import RunnableConfig
+from langgraph.types import StreamWriter
 
 from .state import GraphState
-from .tools import WebSearchTool
+from .tools import WebSearchTool, SearchRateLimitError
 from .logger import get_logger
 
 # Get the logger
 logger = get_logger()
 
+# Each focus primes one query-generation call; the calls run concurrently
+QUERY_FOCUSES = [
+    "Cover the question broadly.",
+    "Focus on specific facts, figures and dates.",
+    "Focus on authoritative, primary sources.",
+]
+# Upper bound on the merged queries sent to web search
+MAX_QUERIES = 5
+# Document content is truncated to this many characters before it goes into a prompt
+MAX_DOC_CHARS = 800
+# Common refinements prefetched while reflect runs, in case another search round follows
+FOLLOWUP_QUERY_TEMPLATES = [
+    "{question} latest",
+    "{question} official source",
+]
+
 # --- Pydantic Models for LLM Outputs ---
 
 class GenerateQueriesOutput(BaseModel):
@@ -45,27 +64,168 @@ class SynthesizeOutput(BaseModel):
         description="A list of citation IDs (e.g., [1, 3]) that were used to generate the answer, in the order they should appear at the end of the answer. These IDs correspond to the original numbering in the provided documents."
     )
 
+# --- Prompt Templates ---
+
+GENERATE_QUERIES_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", "You are a research assistant. Your task is to generate a set of 3-5 diverse and relevant search queries based on a user's question. {focus} Return the queries as a JSON object."),
+    ("user", "User question: {question}")
+])
+
+REFLECT_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", "You are a research analyst. You need to decide if the current search results are sufficient to answer the user's question. If not, generate new queries. Your output must be a JSON object."),
+    ("user", "Original Question: {question}\n\nSearch Results:\n{doc_snippets}\n\nBased on these results, is there enough information to provide a comprehensive answer? If not, what new queries should be run?")
+])
+
+SYNTHESIZE_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", "You are a report writer. Your task is to synthesize a concise English answer (max 80 words) based on the provided documents. Do NOT include citations within the answer text. Instead, provide a list of the IDs of the citations you used to formulate the answer. These IDs correspond to the original numbering in the provided documents. Return a JSON object with the answer and the list of cited IDs."),
+    ("user", "Question: {question}\n\nDocuments:\n{documents}")
+])
+
+# Prompt and output model for each node's structured-output chain
+CHAIN_SPECS = {
+    "generate_queries": (GENERATE_QUERIES_PROMPT, GenerateQueriesOutput),
+    "reflect": (REFLECT_PROMPT, ReflectOutput),
+    "synthesize": (SYNTHESIZE_PROMPT, SynthesizeOutput),
+}
+
 # --- Node Implementations ---
 
+@functools.lru_cache(maxsize=1)
+def load_env() -> bool:
+    """Loads the .env file from the project root at most once per process.
+
+    The directory walk is skipped entirely when the keys are already in the environment.
+    """
+    if not (os.getenv("GOOGLE_API_KEY") or os.getenv("OPENAI_API_KEY")) or not os.getenv("TAVILY_API_KEY"):
+        load_dotenv(find_dotenv(usecwd=False))
+    return True
+
+@functools.lru_cache(maxsize=1)
 def get_llm():
-    """Initializes and returns the appropriate LLM based on available API keys."""
-    # Load .env file from the project root
-    load_dotenv(find_dotenv())
+    """Initializes and returns the appropriate LLM based on available API keys.
+
+    The client is created lazily on first use and shared for the rest of the process.
+    """
+    load_env()
     
     google_api_key = os.getenv("GOOGLE_API_KEY")
     openai_api_key = os.getenv("OPENAI_API_KEY")
     
+    # We use a temperature of 0 for deterministic outputs.
+    # Client-side retries are disabled; llm_retry is the single retry policy.
+    # Provider packages are imported here so only the selected backend is loaded.
     if google_api_key:
         logger.info("--- Using Google Generative AI ---")
-        return ChatGoogleGenerativeAI(model="gemini-1.5-flash", temperature=0)
+        from langchain_google_genai import ChatGoogleGenerativeAI
+        return ChatGoogleGenerativeAI(model="gemini-1.5-flash", temperature=0, max_retries=0)
     elif openai_api_key:
         logger.info("--- Using OpenAI ---")
-        return ChatOpenAI(temperature=0)
+        from langchain_openai import ChatOpenAI
+        return ChatOpenAI(temperature=0, max_retries=0)
     else:
         raise ValueError("No LLM API key found. Please set either GOOGLE_API_KEY or OPENAI_API_KEY.")
 
-# Initialize the LLM. We use a temperature of 0 for deterministic outputs.
-llm = get_llm()
+# HTTP statuses and client exception names (OpenAI SDK, Google API clients, httpx)
+# that signal a transient LLM failure worth retrying
+TRANSIENT_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+TRANSIENT_ERROR_NAMES = {
+    "RateLimitError", "APIConnectionError", "APITimeoutError", "InternalServerError",
+    "ResourceExhausted", "ServiceUnavailable", "DeadlineExceeded",
+    "TransportError",
+}
+
+def error_status(error: BaseException) -> Optional[int]:
+    """Returns the HTTP status code carried by an LLM client error, if any."""
+    # openai.APIStatusError exposes status_code, Google API errors expose code
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(error, "code", None)
+    return status if isinstance(status, int) else None
+
+def is_transient_llm_error(error: BaseException) -> bool:
+    """Returns True for LLM provider errors that are likely to succeed on retry."""
+    # langchain_google_genai wraps the Google client error, so check the cause as well
+    for exc in (error, error.__cause__):
+        if exc is None:
+            continue
+        if error_status(exc) in TRANSIENT_STATUS_CODES:
+            return True
+        if any(cls.__name__ in TRANSIENT_ERROR_NAMES for cls in type(exc).__mro__):
+            return True
+    return isinstance(error, asyncio.TimeoutError)
+
+def is_rate_limit_error(error: BaseException) -> bool:
+    """Returns True if an LLM provider error is a rate limit (HTTP 429)."""
+    for exc in (error, error.__cause__):
+        if exc is None:
+            continue
+        if error_status(exc) == 429:
+            return True
+        if any(cls.__name__ in ("RateLimitError", "ResourceExhausted") for cls in type(exc).__mro__):
+            return True
+    return False
+
+# Retry transient LLM failures (rate limits, 5xx, timeouts) with jittered exponential backoff
+llm_retry = retry(
+    retry=retry_if_exception(is_transient_llm_error),
+    wait=wait_exponential_jitter(initial=0.5, max=8),
+    stop=stop_after_attempt(4),
+    reraise=True,
+)
+
+@llm_retry
+async def ainvoke_with_retry(chain: Runnable, inputs: dict):
+    """Invokes the chain, retrying transient LLM failures."""
+    return await chain.ainvoke(inputs)
+
+@llm_retry
+async def abatch_with_retry(chain: Runnable, inputs: List[dict], config: Optional[dict] = None):
+    """Batches the chain, returning exceptions in place of failed results.
+
+    The batch is retried only if every input failed.
+    """
+    results = await chain.abatch(inputs, config=config, return_exceptions=True)
+    errors = [r for r in results if isinstance(r, Exception)]
+    if errors and len(errors) == len(results):
+        raise errors[0]
+    return results
+
+@llm_retry
+async def astream_with_retry(chain: Runnable, inputs: dict, on_chunk: Callable[[Any], None]):
+    """Streams the chain, passing every chunk to on_chunk, and returns the last chunk."""
+    last_chunk = None
+    async for chunk in chain.astream(inputs):
+        on_chunk(chunk)
+        last_chunk = chunk
+    if last_chunk is None:
+        raise ValueError("The LLM returned no structured output.")
+    return last_chunk
+
+@functools.lru_cache(maxsize=None)
+def get_chain(name: str) -> Runnable:
+    """Builds the structured-output chain for a node on first use and reuses it afterwards."""
+    prompt, output_model = CHAIN_SPECS[name]
+    return prompt | get_llm().with_structured_output(output_model)
+
+@functools.lru_cache(maxsize=None)
+def get_streaming_chain(name: str) -> Runnable:
+    """Builds a chain that streams the node's tool-call arguments as partial dicts.
+
+    The output model is still bound with all its fields required; callers validate
+    the final chunk against it.
+    """
+    prompt, output_model = CHAIN_SPECS[name]
+    tool_name = output_model.__name__
+    llm_with_tool = get_llm().bind_tools([output_model], tool_choice=tool_name)
+    return prompt | llm_with_tool | JsonOutputKeyToolsParser(key_name=tool_name, first_tool_only=True)
+
+def get_shared_search_tool(config: RunnableConfig) -> Optional[WebSearchTool]:
+    """Returns the search tool shared across the run, if the caller configured one."""
+    return config.get("configurable", {}).get("search_tool")
+
+def followup_queries(question: str) -> List[str]:
+    """Returns the speculative follow-up queries for a question."""
+    return [template.format(question=question) for template in FOLLOWUP_QUERY_TEMPLATES]
 
 def log_error(step: str, error_type: str, message: str) -> dict:
     return {
@@ -76,72 +236,92 @@ def log_error(step: str, error_type: str, message: str) -> dict:
         }]
     }
 
-def generate_queries_node(state: GraphState) -> dict:
+async def generate_queries_node(state: GraphState) -> dict:
     """Generates initial search queries based on the user's question."""
     logger.info("--- Node: Generate Queries ---")
     question = state["question"]
 
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", "You are a research assistant. Your task is to generate a set of 3-5 diverse and relevant search queries based on a user's question. Return the queries as a JSON object."),
-        ("user", f"User question: {question}")
-    ])
-
-    llm_with_tools: Runnable = llm.with_structured_output(GenerateQueriesOutput)
-    chain = prompt | llm_with_tools
+    chain = get_chain("generate_queries")
 
     try:
-        result = chain.invoke({})
-        return { "queries": result.queries }
-    except RateLimitError as e:
-        return { "queries": [], **log_error("generate", "RateLimit", str(e)) }
+        results = await abatch_with_retry(
+            chain,
+            [{"question": question, "focus": focus} for focus in QUERY_FOCUSES],
+            config={"max_concurrency": len(QUERY_FOCUSES)},
+        )
+        # Skip variants that failed or returned no structured output
+        outputs = [r for r in results if isinstance(r, GenerateQueriesOutput)]
+        if not outputs:
+            raise ValueError("No query variant returned structured output.")
+
+        # Interleave the variants so every focus is represented, then drop duplicates
+        interleaved = [q for group in zip_longest(*(r.queries for r in outputs)) for q in group if q]
+        unique_queries = {}
+        for q in interleaved:
+            unique_queries.setdefault(WebSearchTool.normalize_query(q), q.strip())
+        queries = list(unique_queries.values())[:MAX_QUERIES]
+        return { "queries": queries }
     except Exception as e:
-        return { "queries": [], **log_error("generate", "LLMFailure", str(e)) }
+        error_type = "RateLimit" if is_rate_limit_error(e) else "LLMFailure"
+        return { "queries": [], **log_error("generate", error_type, str(e)) }
 
 
-def web_search_node(state: GraphState) -> dict:
+async def web_search_node(state: GraphState, config: RunnableConfig) -> dict:
     """Performs web searches for the given queries and updates the documents in the state."""
     logger.info("--- Node: Web Search ---")
     queries = state["queries"]
+    loop_count = state.get("loop_count", 0)
+
+    shared_tool = get_shared_search_tool(config)
     
-    search_tool = WebSearchTool()
-    # Run the async tool in a sync context
+    # Reuse the run's search tool so its query cache spans all search rounds.
+    # Prefetched follow-ups that match one of the queries are harvested instead of re-sent.
+    search_tool = shared_tool or WebSearchTool()
     try:
-        documents = asyncio.run(search_tool.run_concurrent(queries))
-        
-        # Append new documents to existing ones
-        existing_docs = state.get("documents", [])
-        all_docs = existing_docs + documents
+        documents = await search_tool.run_concurrent(queries)
+
+        # Prefetches that did not match any query are not needed
+        if shared_tool is not None:
+            shared_tool.cancel_prefetch()
+
+        # Merge new documents into the existing ones, keyed by url
+        new_docs = {doc["url"]: doc for doc in documents}
+        all_docs = {**state.get("documents", {}), **new_docs}
+
+        # If another round is possible, prefetch likely follow-ups while reflect runs.
+        # Only a shared tool outlives this node, so only it can harvest the prefetch;
+        # without documents the graph goes straight to synthesize, so nothing would.
+        if shared_tool is not None and all_docs and loop_count + 1 < state["max_iter"]:
+            await shared_tool.prefetch(followup_queries(state["question"]))
         
         return {"documents": all_docs, "queries": []} # Clear queries after search
     except Exception as e:
-        if "429" in str(e) or "Too Many Requests" in str(e):
-            return { "documents": state.get("documents", []), **log_error("search", "RateLimit", str(e)) }
-        else:
-            return { "documents": state.get("documents", []), **log_error("search", "HTTPError", str(e)) }
+        error_type = "RateLimit" if isinstance(e, SearchRateLimitError) else "HTTPError"
+        return { "documents": state.get("documents", {}), **log_error("search", error_type, str(e)) }
 
-def reflect_node(state: GraphState) -> dict:
+async def reflect_node(state: GraphState) -> dict:
     """Reflects on the gathered information and decides if more searching is needed."""
     logger.info("--- Node: Reflect ---")
     question = state["question"]
     documents = state["documents"]
+    loop_count = state.get("loop_count", 0) + 1
+
+    # No search round can follow this one, so skip the LLM call whose answer could not be acted on
+    if loop_count >= state["max_iter"]:
+        logger.info("Reflection skipped: maximum iterations reached")
+        return {"need_more": False, "queries": [], "loop_count": loop_count}
 
     # Format documents for the prompt
-    doc_snippets = "\n".join([f"- {doc['content']}" for doc in documents])
-    
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", "You are a research analyst. You need to decide if the current search results are sufficient to answer the user's question. If not, generate new queries. Your output must be a JSON object."),
-        ("user", f"Original Question: {question}\n\nSearch Results:\n{doc_snippets}\n\nBased on these results, is there enough information to provide a comprehensive answer? If not, what new queries should be run?")
-    ])
+    doc_snippets = "\n".join([f"- {doc['content'][:MAX_DOC_CHARS]}" for doc in documents.values()])
     
-    llm_with_tools = llm.with_structured_output(ReflectOutput)
-    chain = prompt | llm_with_tools
+    chain = get_chain("reflect")
     
-    result = chain.invoke({})
+    result = await ainvoke_with_retry(chain, {"question": question, "doc_snippets": doc_snippets})
     
     logger.info(f"Reflection: Need more info? {result.need_more}")
-    return {"need_more": result.need_more, "queries": result.new_queries or [], "loop_count": state.get("loop_count", 0) + 1}
+    return {"need_more": result.need_more, "queries": result.new_queries or [], "loop_count": loop_count}
 
-def synthesize_node(state: GraphState) -> dict:
+async def synthesize_node(state: GraphState, writer: StreamWriter) -> dict:
     """Synthesizes the final answer from the gathered documents."""
     logger.info("--- Node: Synthesize ---")
     question = state["question"]
@@ -154,26 +334,18 @@ def synthesize_node(state: GraphState) -> dict:
         return {"final_answer": "No information found.", "citations": []}
 
     # Prepare documents for the prompt with their original IDs
-    doc_for_llm_prompt = []
-    original_citations_map = {} # Map original ID to full document
-    for i, doc in enumerate(documents):
-        citation_id = i + 1
-        doc_for_llm_prompt.append(
-            f"[Citation {citation_id}] URL: {doc['url']}\nTitle: {doc['title']}\nContent: {doc['content']}"
-        )
-        original_citations_map[citation_id] = doc # Store the full document for later retrieval
-
-    doc_for_llm_prompt_str = "\n".join(doc_for_llm_prompt)
-
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", "You are a report writer. Your task is to synthesize a concise English answer (max 80 words) based on the provided documents. Do NOT include citations within the answer text. Instead, provide a list of the IDs of the citations you used to formulate the answer. These IDs correspond to the original numbering in the provided documents. Return a JSON object with the answer and the list of cited IDs."),
-        ("user", f"Question: {question}\n\nDocuments:\n{doc_for_llm_prompt_str}")
-    ])
+    original_citations_map = dict(enumerate(documents.values(), start=1)) # Map original ID to full document
+    doc_for_llm_prompt_str = "\n".join(
+        f"[Citation {citation_id}] URL: {doc['url']}\nTitle: {doc['title']}\nContent: {doc['content'][:MAX_DOC_CHARS]}"
+        for citation_id, doc in original_citations_map.items()
+    )
 
-    llm_with_tools = llm.with_structured_output(SynthesizeOutput)
-    chain = prompt | llm_with_tools
+    chain = get_streaming_chain("synthesize")
 
-    llm_result = chain.invoke({})
+    # Stream the partial answer to the caller while the LLM is still generating it,
+    # then validate the complete output
+    final_chunk = await astream_with_retry(chain, {"question": question, "documents": doc_for_llm_prompt_str}, lambda chunk: writer({"answer": (chunk or {}).get("answer") or ""}))
+    llm_result = SynthesizeOutput.model_validate(final_chunk)
 
     final_answer_text = llm_result.answer
     cited_original_ids_from_llm = llm_result.cited_ids
@@ -181,19 +353,18 @@ def synthesize_node(state: GraphState) -> dict:
     # Construct the final citation string [1][2]... and map original IDs to new sequential IDs
     citation_string_at_end = ""
     final_citations_list = []
-    seen_urls = set() # To ensure unique citations in the final list
     original_to_new_id_map = {}
 
     for original_id in cited_original_ids_from_llm:
         doc = original_citations_map.get(original_id)
-        if doc and doc['url'] not in seen_urls:
+        # Documents are unique per url, so skipping repeated IDs keeps citations unique
+        if doc and original_id not in original_to_new_id_map:
             new_id = len(final_citations_list) + 1
             final_citations_list.append({
                 "id": new_id,
                 "url": doc['url'],
                 "title": doc['title']
             })
-            seen_urls.add(doc['url'])
             original_to_new_id_map[original_id] = new_id
     
     # Use the mapping to create the citation string with new sequential IDs
@@ -205,4 +376,25 @@ def synthesize_node(state: GraphState) -> dict:
     output = {"final_answer": full_answer, "citations": final_citations_list}
     logger.info(f"Final output: {output}")
 
-    return output
\ No newline at end of file
+    return output
+
+async def synthesize_speculative_node(state: GraphState, writer: StreamWriter) -> dict:
+    """Drafts the final answer in parallel with the reflect node."""
+    logger.info("--- Node: Synthesize (speculative) ---")
+    # Neither branch mutates the state, so the draft can read it directly
+    draft = await synthesize_node(state, writer)
+    return {"speculative_answer": draft["final_answer"], "speculative_citations": draft["citations"]}
+
+def merge_speculative_node(state: GraphState, config: RunnableConfig) -> dict:
+    """Keeps the speculative draft if reflection ends the loop, otherwise discards it."""
+    logger.info("--- Node: Merge Speculative ---")
+    if state["need_more"] and state["loop_count"] < state["max_iter"]:
+        logger.info("Discarding speculative answer, another search round is needed")
+        return {"speculative_answer": "", "speculative_citations": []}
+
+    # No further search round, so prefetched follow-ups will never be harvested
+    shared_tool = get_shared_search_tool(config)
+    if shared_tool is not None:
+        shared_tool.cancel_prefetch()
+
+    return {"final_answer": state["speculative_answer"], "citations": state["speculative_citations"]}
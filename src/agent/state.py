@@ -1,4 +1,4 @@
-from typing import List, TypedDict, Optional, Literal
+from typing import Dict, List, TypedDict, Optional, Literal
 
 class Document(TypedDict):
     url: str
@@ -15,10 +15,12 @@ class GraphError(TypedDict):
 class GraphState(TypedDict):
     question: str
     queries: List[str]
-    documents: List[Document]
+    documents: Dict[str, Document]  # Keyed by url
     need_more: bool
     final_answer: str
     citations: List[dict]
+    speculative_answer: str
+    speculative_citations: List[dict]
     loop_count: int
     max_iter: int
     errors: List[GraphError]
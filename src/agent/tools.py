@@ -1,14 +1,33 @@
 import os
+import re
 import httpx
 import asyncio
-from typing import List, Dict, Any
+import functools
+from typing import List, Dict, Any, Optional
 
-from langchain_tavily import TavilySearch
+from langchain_core.tools import ToolException
 from .logger import get_logger
 
 # Get the logger
 logger = get_logger()
 
+class SearchRateLimitError(Exception):
+    """Raised when the search provider rejects a request with HTTP 429."""
+
+def search_error_status(error: Exception) -> Optional[int]:
+    """Returns the HTTP status code carried by a search provider error, if any."""
+    # aiohttp.ClientResponseError
+    status = getattr(error, "status", None)
+    if isinstance(status, int):
+        return status
+    # httpx.HTTPStatusError
+    status = getattr(getattr(error, "response", None), "status_code", None)
+    if isinstance(status, int):
+        return status
+    # langchain_tavily reports non-200 responses as a plain Exception("Error <status>: <reason>")
+    match = re.match(r"Error (\d{3})\b", str(error))
+    return int(match.group(1)) if match else None
+
 # A simple mock tool for offline development and testing
 async def mock_web_search(query: str) -> List[Dict[str, str]]:
     """A mock web search function that returns dummy results."""
@@ -16,6 +35,17 @@ async def mock_web_search(query: str) -> List[Dict[str, str]]:
     await asyncio.sleep(1) # Simulate network latency
     return []
 
+@functools.lru_cache(maxsize=1)
+def get_tavily_search():
+    """Creates the Tavily client on first use and shares it across all searches."""
+    # Imported lazily so mock-only runs never load the Tavily package
+    from langchain_tavily import TavilySearch
+
+    # TavilySearch automatically picks up TAVILY_API_KEY from environment.
+    # handle_tool_error=False makes it raise ToolException on empty results
+    # instead of returning the message as a string.
+    return TavilySearch(max_results=3, handle_tool_error=False)
+
 async def tavily_web_search(query: str) -> List[Dict[str, str]]:
     """Performs a web search using the Tavily Search API."""
     api_key = os.getenv("TAVILY_API_KEY")
@@ -23,12 +53,19 @@ async def tavily_web_search(query: str) -> List[Dict[str, str]]:
         logger.info("TAVILY_API_KEY is not set. Falling back to mock search.")
         return []
 
-    # TavilySearchResults automatically picks up TAVILY_API_KEY from environment
-    search = TavilySearch(max_results=3)
+    search = get_tavily_search()
     
     try:
         # TavilySearchResults.arun returns a dictionary with a 'results' key
-        raw_results = await search.arun(query)
+        try:
+            raw_results = await search.arun(query)
+        except ToolException:
+            # TavilySearch raises ToolException when a query has no results
+            logger.info(f"No Tavily results for: {query}")
+            return []
+        if raw_results.get("error"):
+            error = raw_results["error"]
+            raise error if isinstance(error, Exception) else RuntimeError(str(error))
         
         # Extract the list of results from the 'results' key
         results_list = raw_results.get('results', [])
@@ -45,41 +82,123 @@ async def tavily_web_search(query: str) -> List[Dict[str, str]]:
         return parsed_results
     except Exception as e:
         logger.error(f"An error occurred during Tavily search: {e}")
-        return []
+        if search_error_status(e) == 429:
+            raise SearchRateLimitError(str(e)) from e
+        raise
 
 class WebSearchTool:
     """
     A tool to perform concurrent web searches using either Tavily or a mock tool.
-    It automatically de-duplicates results based on the 'url'.
+    It automatically de-duplicates queries and results based on the 'url'.
+    Results are cached per instance, so sharing one instance across search rounds
+    avoids re-sending queries that were already answered. Queries can also be
+    prefetched in the background and are harvested by a later run_concurrent call.
     """
+    def __init__(self, max_concurrency: int = 3):
+        # Maps a normalized query to its search results
+        self._query_cache: Dict[str, List[Dict[str, str]]] = {}
+        # Maps a normalized query to its in-flight prefetch task
+        self._prefetched: Dict[str, asyncio.Task] = {}
+        # Caps in-flight searches below the provider's rate limit
+        self.max_concurrency = max_concurrency
+        # Created on first use so it binds to the running event loop
+        self._sem: Optional[asyncio.Semaphore] = None
+
+    @staticmethod
+    def normalize_query(query: str) -> str:
+        """Returns the cache key for a query."""
+        return query.strip().lower()
+
+    def _unique_queries(self, queries: List[str]) -> Dict[str, str]:
+        """Collapses duplicate queries, keeping the first spelling of each."""
+        unique_queries: Dict[str, str] = {}
+        for q in queries:
+            key = self.normalize_query(q)
+            if key:
+                unique_queries.setdefault(key, q.strip())
+        return unique_queries
+
+    def _select_search_func(self):
+        """Prioritizes Tavily, then falls back to the mock search."""
+        if os.getenv("TAVILY_API_KEY"):
+            logger.info("--- Using Tavily Search ---")
+            return tavily_web_search
+        logger.info("--- Using Mock Search ---")
+        return mock_web_search
+
+    async def _bounded_search(self, search_func, query: str) -> List[Dict[str, str]]:
+        """Runs one search while holding a concurrency slot."""
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.max_concurrency)
+        async with self._sem:
+            return await search_func(query)
+
+    async def prefetch(self, queries: List[str]) -> None:
+        """Starts background searches for queries that are likely to be requested next."""
+        to_prefetch = {
+            key: q for key, q in self._unique_queries(queries).items()
+            if key not in self._query_cache and key not in self._prefetched
+        }
+        if not to_prefetch:
+            return
+
+        search_func = self._select_search_func()
+        logger.info(f"Prefetching {len(to_prefetch)} queries")
+        for key, q in to_prefetch.items():
+            self._prefetched[key] = asyncio.create_task(self._bounded_search(search_func, q))
+
+    def cancel_prefetch(self) -> None:
+        """Cancels prefetched searches that have not been harvested."""
+        for task in self._prefetched.values():
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                # Retrieve the outcome so a failed prefetch is not reported as never retrieved
+                task.exception()
+        self._prefetched.clear()
+
     async def run_concurrent(self, queries: List[str]) -> List[Dict[str, str]]:
         """
         Runs web searches for a list of queries concurrently.
         Prioritizes Tavily, then falls back to the mock search.
         """
-        search_func = None
-        if os.getenv("TAVILY_API_KEY"):
-            search_func = tavily_web_search
-            logger.info("--- Using Tavily Search ---")
-        else:
-            search_func = mock_web_search
-            logger.info("--- Using Mock Search ---")
-        
-        tasks = [search_func(q) for q in queries]
+        search_func = self._select_search_func()
+        unique_queries = self._unique_queries(queries)
+
+        # Only dispatch the queries that are not cached yet
+        to_dispatch = {key: q for key, q in unique_queries.items() if key not in self._query_cache}
+        if len(to_dispatch) < len(unique_queries):
+            logger.info(f"Skipping {len(unique_queries) - len(to_dispatch)} cached queries")
+
+        # Harvest prefetched searches instead of dispatching them again
+        tasks = []
+        for key, q in to_dispatch.items():
+            prefetched = self._prefetched.pop(key, None)
+            if prefetched is not None:
+                logger.info(f"Harvesting prefetched query: {q}")
+            tasks.append(prefetched or self._bounded_search(search_func, q))
         results_lists = await asyncio.gather(*tasks, return_exceptions=True)
-        
-        # Flatten the list of lists and filter out any exceptions
-        flat_results = []
-        for res in results_lists:
+
+        # Cache successful results, filtering out any exceptions
+        errors = []
+        for key, res in zip(to_dispatch, results_lists):
             if isinstance(res, list):
-                flat_results.extend(res)
+                self._query_cache[key] = res
+            elif isinstance(res, BaseException):
+                errors.append(res)
+
+        # Flatten the list of lists, cached results included
+        flat_results = []
+        for key in unique_queries:
+            flat_results.extend(self._query_cache.get(key, []))
+
+        # Surface a failure only when there is nothing to return, so the caller can classify it
+        if errors and not flat_results:
+            raise errors[0]
         
-        # De-duplicate results based on the 'url'
-        seen_urls = set()
-        unique_results = []
+        # De-duplicate results based on the 'url', keeping the first occurrence
+        unique_results: Dict[str, Dict[str, str]] = {}
         for result in flat_results:
-            if result['url'] not in seen_urls:
-                unique_results.append(result)
-                seen_urls.add(result['url'])
+            unique_results.setdefault(result['url'], result)
                 
-        return unique_results
\ No newline at end of file
+        return list(unique_results.values())
\ No newline at end of file
@@ -1,9 +1,22 @@
 import pytest
 from unittest.mock import patch, AsyncMock, MagicMock
 import asyncio
-from src.agent.graph import app
+import gc
+from src.agent.graph import app, build_app
+from langgraph.checkpoint.memory import MemorySaver
+from src.agent.main import stream_agent
 from src.agent.state import GraphState
-from src.agent.tools import WebSearchTool
+from src.agent.tools import WebSearchTool, SearchRateLimitError, get_tavily_search
+from src.agent.nodes import (
+    reflect_node,
+    web_search_node,
+    generate_queries_node,
+    ainvoke_with_retry,
+    GenerateQueriesOutput,
+    ReflectOutput,
+    MAX_QUERIES,
+)
+from tenacity import wait_none
 import aiohttp
 
 
@@ -29,6 +42,9 @@ def mock_search_tool(mock_search_results):
     """Fixture providing a mock WebSearchTool that returns predefined results."""
     mock_tool = WebSearchTool()
     mock_tool.run_concurrent = AsyncMock(return_value=mock_search_results)
+    # Never start real (billed) background searches from tests
+    mock_tool.prefetch = AsyncMock()
+    mock_tool.cancel_prefetch = MagicMock()
     return mock_tool
 
 
@@ -44,14 +60,7 @@ def empty_search_tool():
 def rate_limited_search_tool():
     """Fixture providing a mock WebSearchTool that raises a rate limit error."""
     mock_instance = AsyncMock()
-    http_error = aiohttp.ClientResponseError(
-        request_info=MagicMock(),
-        history=(),
-        status=429,
-        message="Too Many Requests",
-        headers={}
-    )
-    mock_instance.run_concurrent.side_effect = http_error
+    mock_instance.run_concurrent.side_effect = SearchRateLimitError("Error 429: Too Many Requests")
     return mock_instance
 
 
@@ -108,10 +117,12 @@ def base_state():
     return GraphState(
         question="",
         queries=[],
-        documents=[],
+        documents={},
         need_more=False,
         final_answer="",
         citations=[],
+        speculative_answer="",
+        speculative_citations=[],
         loop_count=0,
         max_iter=2,
         errors=[]
@@ -148,7 +159,8 @@ def france_query_state(france_question_state):
 
 
 @pytest.mark.parametrize("state_fixture", ["france_question_state"])
-def test_agent_happy_path(mock_search_tool, request, state_fixture):
+@pytest.mark.asyncio
+async def test_agent_happy_path(mock_search_tool, request, state_fixture):
     """Test the happy path where initial search results are sufficient."""
     # Get the parameterized state
     initial_state = request.getfixturevalue(state_fixture)
@@ -156,7 +168,7 @@ def test_agent_happy_path(mock_search_tool, request, state_fixture):
     # Patch the WebSearchTool class
     with patch('src.agent.nodes.WebSearchTool', return_value=mock_search_tool):
         # Run the agent
-        final_state = app.invoke(initial_state)
+        final_state = await app.ainvoke(initial_state)
         
         # Verify the final answer exists and contains citations
         assert final_state["final_answer"], "Final answer should not be empty"
@@ -174,10 +186,11 @@ def test_agent_happy_path(mock_search_tool, request, state_fixture):
         assert "Paris" in final_state["final_answer"], "Answer should mention Paris"
 
 
-def test_agent_no_results(empty_search_tool, atlantis_question_state):
+@pytest.mark.asyncio
+async def test_agent_no_results(empty_search_tool, atlantis_question_state):
     """Test the agent's handling of empty search results."""
     with patch('src.agent.nodes.WebSearchTool', return_value=empty_search_tool):
-        final_state = app.invoke(atlantis_question_state)
+        final_state = await app.ainvoke(atlantis_question_state)
 
         assert not final_state["need_more"]
         assert final_state["final_answer"]
@@ -189,10 +202,11 @@ def test_agent_no_results(empty_search_tool, atlantis_question_state):
         assert final_state["citations"] == []
 
 
-def test_agent_rate_limit_error(rate_limited_search_tool, france_query_state):
+@pytest.mark.asyncio
+async def test_agent_rate_limit_error(rate_limited_search_tool, france_query_state):
     """Test the agent's handling of HTTP 429 rate limit errors."""
     with patch('src.agent.nodes.WebSearchTool', return_value=rate_limited_search_tool):
-        final_state = app.invoke(france_query_state)
+        final_state = await app.ainvoke(france_query_state)
         
         # Verify the agent handles the rate limit error gracefully
         assert final_state["final_answer"], "Final answer should not be empty"
@@ -203,15 +217,17 @@ def test_agent_rate_limit_error(rate_limited_search_tool, france_query_state):
         ), "Answer should mention rate limiting"
         assert not final_state["need_more"], "need_more should be False after rate limit error"
         assert final_state["citations"] == [], "Citations should be empty for rate limit error"
+        assert final_state["errors"][0]["error_type"] == "RateLimit", "429 should be classified as a rate limit"
         
         # Verify the search tool was called
         rate_limited_search_tool.run_concurrent.assert_called_once()
 
 
-def test_agent_timeout_error(timeout_search_tool, france_query_state):
+@pytest.mark.asyncio
+async def test_agent_timeout_error(timeout_search_tool, france_query_state):
     """Test the agent's handling of timeout errors during web search."""
     with patch('src.agent.nodes.WebSearchTool', return_value=timeout_search_tool):
-        final_state = app.invoke(france_query_state)
+        final_state = await app.ainvoke(france_query_state)
         
         # Verify the agent handles the timeout error gracefully
         assert final_state["final_answer"], "Final answer should not be empty"
@@ -223,11 +239,12 @@ def test_agent_timeout_error(timeout_search_tool, france_query_state):
         timeout_search_tool.run_concurrent.assert_called_once()
 
 
-def test_agent_two_round_search(two_round_search_tool, worldcup_question_state):
+@pytest.mark.asyncio
+async def test_agent_two_round_search(two_round_search_tool, worldcup_question_state):
     """Test the agent performing a two-round search with reflection in between."""
     # Create a patched reflect_node that will set need_more=True on first call
     # and increment loop_count
-    def patched_reflect_node(state):
+    async def patched_reflect_node(state):
         # Increment loop count
         current_loop_count = state.get("loop_count", 0)
         
@@ -250,7 +267,7 @@ def test_agent_two_round_search(two_round_search_tool, worldcup_question_state):
          patch('src.agent.nodes.reflect_node', side_effect=patched_reflect_node):
         
         # Run the agent
-        final_state = app.invoke(worldcup_question_state)
+        final_state = await app.ainvoke(worldcup_question_state)
         
         # Verify the search tool was called twice
         assert two_round_search_tool.run_concurrent.call_count == 2, "Search tool should be called twice"
@@ -274,3 +291,381 @@ def test_agent_two_round_search(two_round_search_tool, worldcup_question_state):
         # Verify the loop_count was incremented
         assert final_state["loop_count"] > 0, "Loop count should be incremented"
 
+
+
+@pytest.mark.asyncio
+async def test_web_search_tool_dedupes_and_caches_queries(mock_search_results, monkeypatch):
+    """Test that duplicate queries are dispatched once and cached queries are not re-sent."""
+    monkeypatch.delenv("TAVILY_API_KEY", raising=False)
+    search_func = AsyncMock(return_value=mock_search_results)
+
+    with patch('src.agent.tools.mock_web_search', search_func):
+        tool = WebSearchTool()
+
+        first = await tool.run_concurrent(["capital of France", " Capital of France ", "CAPITAL OF FRANCE"])
+        assert search_func.call_count == 1, "Duplicate queries should be dispatched once"
+        assert first == mock_search_results
+
+        second = await tool.run_concurrent(["capital of france", "Paris landmarks"])
+        assert search_func.call_count == 2, "Only the uncached query should be dispatched"
+        search_func.assert_called_with("Paris landmarks")
+        assert second == mock_search_results, "Results should be de-duplicated by url"
+
+
+@pytest.mark.asyncio
+async def test_web_search_tool_bounds_concurrency(monkeypatch):
+    """Test that no more than max_concurrency searches are in flight at once."""
+    monkeypatch.delenv("TAVILY_API_KEY", raising=False)
+    in_flight = 0
+    peak = 0
+
+    async def slow_search(query):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        return [{"url": f"https://example.com/{query}", "title": query, "content": query}]
+
+    with patch('src.agent.tools.mock_web_search', side_effect=slow_search):
+        tool = WebSearchTool(max_concurrency=2)
+        results = await tool.run_concurrent([f"query {i}" for i in range(6)])
+
+    assert len(results) == 6
+    assert peak == 2, "At most max_concurrency searches should run concurrently"
+
+
+@pytest.mark.asyncio
+async def test_web_search_tool_raises_when_all_queries_fail(monkeypatch):
+    """Test that run_concurrent re-raises the error when every query fails."""
+    monkeypatch.delenv("TAVILY_API_KEY", raising=False)
+    http_error = aiohttp.ClientResponseError(
+        request_info=MagicMock(),
+        history=(),
+        status=429,
+        message="Too Many Requests",
+        headers={}
+    )
+
+    with patch('src.agent.tools.mock_web_search', AsyncMock(side_effect=http_error)):
+        tool = WebSearchTool()
+        with pytest.raises(aiohttp.ClientResponseError):
+            await tool.run_concurrent(["capital of France", "Paris landmarks"])
+
+
+@pytest.mark.asyncio
+async def test_reflect_skips_llm_on_last_iteration(france_question_state, mock_search_results):
+    """Test that reflect does not call the LLM when no further search round is allowed."""
+    france_question_state["documents"] = {doc["url"]: doc for doc in mock_search_results}
+    france_question_state["loop_count"] = france_question_state["max_iter"] - 1
+
+    with patch('src.agent.nodes.get_chain') as get_chain:
+        result = await reflect_node(france_question_state)
+
+    get_chain.assert_not_called()
+    assert result == {"need_more": False, "queries": [], "loop_count": france_question_state["max_iter"]}
+
+
+@pytest.mark.asyncio
+async def test_web_search_tool_harvests_prefetched_queries(mock_search_results, monkeypatch):
+    """Test that prefetched queries are not dispatched again when they are requested."""
+    monkeypatch.delenv("TAVILY_API_KEY", raising=False)
+    search_func = AsyncMock(return_value=mock_search_results)
+
+    with patch('src.agent.tools.mock_web_search', search_func):
+        tool = WebSearchTool()
+        await tool.prefetch(["capital of France latest"])
+        results = await tool.run_concurrent(["Capital of France latest", "Paris landmarks"])
+
+    assert search_func.call_count == 2, "The prefetched query should be harvested, not re-sent"
+    assert results == mock_search_results
+
+
+@pytest.fixture
+def tavily_search(monkeypatch):
+    """Fixture providing the shared TavilySearch client with a test API key."""
+    monkeypatch.setenv("TAVILY_API_KEY", "test-key")
+    get_tavily_search.cache_clear()
+    yield get_tavily_search()
+    get_tavily_search.cache_clear()
+
+
+@pytest.mark.asyncio
+async def test_tavily_no_results_is_an_empty_result(tavily_search, atlantis_question_state):
+    """Test that a Tavily query with no results ends in no documents, not a search failure."""
+    raw_results = AsyncMock(return_value={"results": []})
+
+    with patch.object(type(tavily_search.api_wrapper), "raw_results_async", raw_results):
+        result = await web_search_node(atlantis_question_state, {})
+
+    assert raw_results.await_count == 2
+    assert result == {"documents": {}, "queries": []}
+
+
+@pytest.mark.asyncio
+async def test_web_search_tool_keeps_cached_results_when_new_queries_fail(mock_search_results, monkeypatch):
+    """Test that a failing query does not hide results that are already cached."""
+    monkeypatch.delenv("TAVILY_API_KEY", raising=False)
+
+    with patch('src.agent.tools.mock_web_search', AsyncMock(return_value=mock_search_results)):
+        tool = WebSearchTool()
+        await tool.run_concurrent(["capital of France"])
+
+    with patch('src.agent.tools.mock_web_search', AsyncMock(side_effect=asyncio.TimeoutError())):
+        results = await tool.run_concurrent(["capital of France", "Paris landmarks"])
+
+    assert results == mock_search_results
+
+
+@pytest.mark.asyncio
+async def test_tavily_rate_limit_is_classified(tavily_search, france_query_state):
+    """Test that a Tavily 429 surfaces as a RateLimit error in the web search node."""
+    # langchain_tavily reports non-200 responses as a plain Exception("Error <status>: <reason>")
+    raw_results = AsyncMock(side_effect=Exception("Error 429: Too Many Requests"))
+
+    with patch.object(type(tavily_search.api_wrapper), "raw_results_async", raw_results):
+        result = await web_search_node(france_query_state, {})
+
+    assert result["errors"][0]["error_type"] == "RateLimit"
+
+
+@pytest.mark.asyncio
+async def test_web_search_prefetches_only_with_shared_tool(france_query_state, mock_search_results):
+    """Test that follow-ups are prefetched on the run's shared tool and never on a throwaway one."""
+    fresh_tool = AsyncMock()
+    fresh_tool.run_concurrent.return_value = mock_search_results
+    with patch('src.agent.nodes.WebSearchTool', return_value=fresh_tool):
+        await web_search_node(france_query_state, {})
+    fresh_tool.prefetch.assert_not_called()
+
+    shared_tool = AsyncMock()
+    shared_tool.run_concurrent.return_value = mock_search_results
+    shared_tool.cancel_prefetch = MagicMock()
+    await web_search_node(france_query_state, {"configurable": {"search_tool": shared_tool}})
+    shared_tool.prefetch.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_follow_up_round_only_sends_reflect_queries(france_query_state, mock_search_results):
+    """Test that a follow-up round searches only reflect's queries and drops unmatched prefetches."""
+    france_query_state["loop_count"] = 1
+    shared_tool = AsyncMock()
+    shared_tool.run_concurrent.return_value = mock_search_results
+    shared_tool.cancel_prefetch = MagicMock()
+
+    await web_search_node(france_query_state, {"configurable": {"search_tool": shared_tool}})
+
+    shared_tool.run_concurrent.assert_awaited_once_with(["capital of France"])
+    shared_tool.cancel_prefetch.assert_called_once()
+    shared_tool.prefetch.assert_not_called()
+
+
+class ServiceUnavailableError(Exception):
+    """A provider-style error carrying an HTTP 503 status code."""
+    status_code = 503
+
+
+@pytest.mark.asyncio
+async def test_llm_retry_recovers_from_transient_error():
+    """Test that a transient LLM failure is retried and the next attempt's result is returned."""
+    chain = MagicMock()
+    chain.ainvoke = AsyncMock(side_effect=[ServiceUnavailableError("Service Unavailable"), "ok"])
+
+    result = await ainvoke_with_retry.retry_with(wait=wait_none())(chain, {})
+
+    assert result == "ok"
+    assert chain.ainvoke.await_count == 2
+
+
+@pytest.mark.asyncio
+async def test_llm_retry_does_not_retry_permanent_errors():
+    """Test that non-transient LLM errors are raised without retrying."""
+    chain = MagicMock()
+    chain.ainvoke = AsyncMock(side_effect=ValueError("Invalid request"))
+
+    with pytest.raises(ValueError):
+        await ainvoke_with_retry.retry_with(wait=wait_none())(chain, {})
+
+    assert chain.ainvoke.await_count == 1
+
+
+@pytest.mark.asyncio
+async def test_generate_queries_merges_variants(france_question_state):
+    """Test that query variants are interleaved, de-duplicated and capped, skipping failed variants."""
+    chain = MagicMock()
+    chain.abatch = AsyncMock(return_value=[
+        GenerateQueriesOutput(queries=["capital of France", "France capital city", "Paris population"]),
+        ValueError("Malformed output"),
+        None,
+        GenerateQueriesOutput(queries=["Capital of France ", "Paris history", "Paris landmarks", "Paris mayor"]),
+    ])
+
+    with patch('src.agent.nodes.get_chain', return_value=chain):
+        result = await generate_queries_node(france_question_state)
+
+    assert "errors" not in result
+    assert result["queries"] == [
+        "capital of France",
+        "France capital city",
+        "Paris history",
+        "Paris population",
+        "Paris landmarks",
+        "Paris mayor",
+    ][:MAX_QUERIES]
+
+
+@pytest.mark.asyncio
+async def test_generate_queries_fails_only_when_every_variant_fails(france_question_state):
+    """Test that the node reports an error only when no variant produced queries."""
+    chain = MagicMock()
+    chain.abatch = AsyncMock(return_value=[ValueError("Malformed output"), None, None])
+
+    with patch('src.agent.nodes.get_chain', return_value=chain):
+        result = await generate_queries_node(france_question_state)
+
+    assert result["queries"] == []
+    assert result["errors"][0]["error_type"] == "LLMFailure"
+
+
+class FakeStreamingChain:
+    """A streaming chain stand-in that yields a partial and then the final output per call."""
+
+    def __init__(self, outputs):
+        self.outputs = iter(outputs)
+        self.calls = 0
+
+    async def astream(self, inputs):
+        self.calls += 1
+        final = next(self.outputs)
+        yield {"answer": final["answer"][:5]}
+        yield final
+
+
+def offline_chains(reflect_outputs, synthesize_outputs):
+    """Returns get_chain / get_streaming_chain patches backed by canned LLM outputs."""
+    generate_chain = MagicMock()
+    generate_chain.abatch = AsyncMock(return_value=[GenerateQueriesOutput(queries=["capital of France"])])
+    reflect_chain = MagicMock()
+    reflect_chain.ainvoke = AsyncMock(side_effect=reflect_outputs)
+    synthesize_chain = FakeStreamingChain(synthesize_outputs)
+    chains = {"generate_queries": generate_chain, "reflect": reflect_chain}
+    return (
+        patch('src.agent.nodes.get_chain', side_effect=lambda name: chains[name]),
+        patch('src.agent.nodes.get_streaming_chain', return_value=synthesize_chain),
+        reflect_chain,
+        synthesize_chain,
+    )
+
+
+@pytest.mark.asyncio
+async def test_speculative_draft_kept_when_reflection_ends_loop(mock_search_tool, france_question_state):
+    """Test that the speculative draft becomes the final answer when no more searching is needed."""
+    get_chain, get_streaming_chain, reflect_chain, synthesize_chain = offline_chains(
+        [ReflectOutput(need_more=False, new_queries=[])],
+        [{"answer": "Paris is the capital of France.", "cited_ids": [1]}],
+    )
+
+    with patch('src.agent.nodes.WebSearchTool', return_value=mock_search_tool), get_chain, get_streaming_chain:
+        final_state = await app.ainvoke(france_question_state)
+
+    assert final_state["final_answer"] == "Paris is the capital of France.[1]"
+    assert final_state["citations"][0]["url"] == "https://example.com/article1"
+    assert mock_search_tool.run_concurrent.await_count == 1
+    assert reflect_chain.ainvoke.await_count == 1
+    assert synthesize_chain.calls == 1, "The draft should be reused, not synthesized again"
+
+
+@pytest.mark.asyncio
+async def test_speculative_draft_discarded_when_reflection_loops(two_round_search_tool, worldcup_question_state):
+    """Test that the first draft is discarded when reflection asks for another search round."""
+    get_chain, get_streaming_chain, reflect_chain, synthesize_chain = offline_chains(
+        [ReflectOutput(need_more=True, new_queries=["World Cup 2022 final result"])],
+        [
+            {"answer": "The 2022 World Cup was held in Qatar.", "cited_ids": [1]},
+            {"answer": "Argentina beat France on penalties.", "cited_ids": [3]},
+        ],
+    )
+
+    with patch('src.agent.nodes.WebSearchTool', return_value=two_round_search_tool), get_chain, get_streaming_chain:
+        final_state = await app.ainvoke(worldcup_question_state)
+
+    assert final_state["final_answer"] == "Argentina beat France on penalties.[1]"
+    assert final_state["citations"] == [
+        {"id": 1, "url": "https://example.com/worldcup3", "title": "Argentina Wins World Cup"}
+    ]
+    assert two_round_search_tool.run_concurrent.await_count == 2
+    # The second reflection is skipped because max_iter is reached
+    assert reflect_chain.ainvoke.await_count == 1
+    assert synthesize_chain.calls == 2
+
+
+@pytest.mark.asyncio
+async def test_stream_agent_echoes_partial_answers(mock_search_tool, france_question_state, capsys):
+    """Test that the CLI streaming path writes partial answers to stderr and returns the final state."""
+    get_chain, get_streaming_chain, _, _ = offline_chains(
+        [ReflectOutput(need_more=False, new_queries=[])],
+        [{"answer": "Paris is the capital of France.", "cited_ids": [1]}],
+    )
+
+    with get_chain, get_streaming_chain:
+        final_state = await stream_agent(france_question_state, {"configurable": {"search_tool": mock_search_tool}})
+
+    assert final_state["final_answer"] == "Paris is the capital of France.[1]"
+    captured = capsys.readouterr()
+    assert captured.err == "Paris is the capital of France.\n"
+    assert captured.out == ""
+
+
+@pytest.mark.asyncio
+async def test_web_search_skips_prefetch_without_documents(france_query_state):
+    """Test that no follow-ups are prefetched when the search found nothing, since no round would harvest them."""
+    shared_tool = AsyncMock()
+    shared_tool.run_concurrent.return_value = []
+    shared_tool.cancel_prefetch = MagicMock()
+
+    await web_search_node(france_query_state, {"configurable": {"search_tool": shared_tool}})
+
+    shared_tool.prefetch.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_cancel_prefetch_retrieves_failed_prefetches(monkeypatch):
+    """Test that cancelling consumes exceptions from prefetches that already failed."""
+    monkeypatch.delenv("TAVILY_API_KEY", raising=False)
+    loop = asyncio.get_running_loop()
+    unhandled = []
+    loop.set_exception_handler(lambda loop, context: unhandled.append(context))
+
+    try:
+        with patch('src.agent.tools.mock_web_search', AsyncMock(side_effect=asyncio.TimeoutError())):
+            tool = WebSearchTool()
+            await tool.prefetch(["capital of France latest"])
+            failed_task = next(iter(tool._prefetched.values()))
+            await asyncio.wait([failed_task])
+
+        tool.cancel_prefetch()
+        del failed_task
+        gc.collect()
+    finally:
+        loop.set_exception_handler(None)
+
+    assert tool._prefetched == {}
+    assert unhandled == [], "A failed prefetch should not be reported as never retrieved"
+
+
+@pytest.mark.asyncio
+async def test_build_app_with_checkpointer_saves_run_state(mock_search_tool, france_question_state):
+    """Test that an app compiled with a checkpointer runs under a thread_id and keeps its final state."""
+    get_chain, get_streaming_chain, _, _ = offline_chains(
+        [ReflectOutput(need_more=False, new_queries=[])],
+        [{"answer": "Paris is the capital of France.", "cited_ids": [1]}],
+    )
+    resumable_app = build_app(checkpointer=MemorySaver())
+    config = {"configurable": {"thread_id": "test-run", "search_tool": mock_search_tool}}
+
+    with get_chain, get_streaming_chain:
+        final_state = await resumable_app.ainvoke(france_question_state, config=config)
+
+    snapshot = await resumable_app.aget_state(config)
+    assert snapshot.values["final_answer"] == final_state["final_answer"] == "Paris is the capital of France.[1]"
+    assert snapshot.next == (), "A completed run should have no pending nodes"